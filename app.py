@@ -12,15 +12,47 @@ import time
 import logging
 from datetime import datetime
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request, send_file
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
+
+# One native thread per worker; the file pool size is the only parallelism dial.
+# Must be set before numpy/torch load their BLAS/OpenMP runtimes.
+for _var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+    os.environ.setdefault(_var, '1')
+
 import numpy as np
 import cv2
 from PIL import Image
 import io
 import traceback
 import gc
+import hashlib
+import importlib.util
+from collections import OrderedDict
+from functools import cached_property
+from contextlib import contextmanager
+import queue
+import mmap
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Fast JSON encoding, stdlib json otherwise
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
+# Optional libjpeg-turbo bindings for faster JPEG decoding
+try:
+    from turbojpeg import TurboJPEG, TJPF_GRAY
+    _turbo_jpeg = TurboJPEG()
+except Exception:
+    _turbo_jpeg = None
+
+cv2.setUseOptimized(True)
+cv2.setNumThreads(1)
 
 # Configure logging for production
 logging.basicConfig(
@@ -30,223 +62,535 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class OcrInput:
+    """Preprocessed image with per-engine layouts converted once on demand"""
+    
+    def __init__(self, image):
+        self.image = image
+    
+    @cached_property
+    def gray(self):
+        if self.image.ndim == 3:
+            return cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self.image
+    
+    @cached_property
+    def pil_image(self):
+        # Preprocessed inputs are already 2D, so this wraps them without a copy
+        return Image.fromarray(self.gray)
+
 class OptimizedOCREngine:
     """Lightweight OCR engine optimized for limited resources"""
     
+    # Request language codes -> Tesseract traineddata names
+    _LANG_MAP = {'en': 'eng', 'ja': 'jpn', 'ko': 'kor'}
+    
     def __init__(self):
-        self.engines = {}
+        self._factories = {}
+        self._engines = {}
+        self._lock = threading.Lock()
         self.fallback_available = False
-        self._initialize_engines()
+        self._register_engines()
     
-    def _initialize_engines(self):
-        """Initialize available OCR engines with memory optimization"""
-        # Try EasyOCR first (most reliable)
-        try:
-            import easyocr
-            self.engines['easyocr'] = easyocr.Reader(['en'], gpu=False)  # Only English to save memory
-            logger.info("EasyOCR initialized")
-        except Exception as e:
-            logger.warning(f"EasyOCR not available: {e}")
+    def _register_engines(self):
+        """Register available OCR engines; models load on first use"""
+        # EasyOCR first (most reliable), Reader is built lazily
+        if importlib.util.find_spec('easyocr') is not None:
+            self._factories['easyocr'] = self._make_easyocr
+            logger.info("EasyOCR available")
+        else:
+            logger.warning("EasyOCR not available: module not installed")
         
         # Try Tesseract as backup
         try:
             import pytesseract
             pytesseract.get_tesseract_version()
-            self.engines['tesseract'] = pytesseract
-            logger.info("Tesseract initialized")
+            self._factories['tesseract'] = self._make_tesseract
+            logger.info("Tesseract available")
         except Exception as e:
             logger.warning(f"Tesseract not available: {e}")
         
         # Always have OpenCV fallback
+        self._factories['opencv'] = self._make_opencv
+        self.fallback_available = True
+        logger.info("OpenCV fallback available")
+    
+    def _make_easyocr(self, languages):
+        import easyocr
+        import torch
+        # Inference runs on the task worker thread, not the per-file pool, so
+        # split the cores between task workers instead of pinning torch to one
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // OCR_WORKERS))
+        
+        # OCR_USE_GPU: 'auto' (default) uses CUDA when present, '1'/'0' force it
+        gpu_setting = os.environ.get('OCR_USE_GPU', 'auto')
+        gpu = torch.cuda.is_available() if gpu_setting == 'auto' else gpu_setting == '1'
+        
+        # Only requested languages to save memory; int8 recognizer on CPU
         try:
-            import cv2
-            self.engines['opencv'] = cv2
-            self.fallback_available = True
-            logger.info("OpenCV fallback available")
+            reader = easyocr.Reader(list(languages), gpu=gpu, quantize=not gpu)
         except Exception as e:
-            logger.error(f"OpenCV failed: {e}")
-        
-        if not self.engines:
-            logger.critical("No OCR engines available!")
+            if gpu:
+                raise
+            logger.warning(f"Quantized EasyOCR unavailable, using fp32: {e}")
+            reader = easyocr.Reader(list(languages), gpu=False, quantize=False)
+        if gpu and os.environ.get('OCR_TORCH_COMPILE') == '1':
+            reader.detector = torch.compile(reader.detector, mode='reduce-overhead')
+            reader.recognizer = torch.compile(reader.recognizer, mode='reduce-overhead')
+        return reader
+    
+    def _make_tesseract(self, languages):
+        import pytesseract
+        return pytesseract
+    
+    def _make_opencv(self, languages):
+        return cv2
+    
+    def _get(self, name, languages=('en',)):
+        """Return the engine, creating it on first use for these languages"""
+        key = (name, tuple(sorted(languages)))
+        engine = self._engines.get(key)
+        if engine is None:
+            with self._lock:
+                engine = self._engines.get(key)
+                if engine is None:
+                    engine = self._factories[name](languages)
+                    self._engines[key] = engine
+                    logger.info(f"{name} initialized for {', '.join(languages)}")
+        return engine
+    
+    def _select(self, languages):
+        """Load the best engine available, dropping ones that fail to initialize"""
+        for name in list(self._factories):
+            try:
+                return name, self._get(name, languages)
+            except Exception as e:
+                logger.warning(f"{name} failed to initialize: {e}")
+                self._factories.pop(name, None)
+        raise RuntimeError("No OCR engines available")
+    
+    def warm_up(self, languages=('en',)):
+        """Load the primary engine and run one dummy inference"""
+        try:
+            name, engine = self._select(languages)
+            if name == 'easyocr':
+                engine.readtext(np.zeros((64, 64, 3), np.uint8), detail=0)
+            logger.info(f"{name} warmed up")
+        except Exception as e:
+            logger.warning(f"OCR warm-up failed: {e}")
+    
+    def available_engines(self):
+        return list(self._factories)
     
     def is_ready(self):
-        return len(self.engines) > 0
+        return len(self._factories) > 0
     
     def extract_text(self, image_array, mode='normal', languages=['en']):
-        """Extract text with memory management"""
+        """Extract text with memory management, returning (text, ok)"""
         if not self.is_ready():
-            return "No OCR engines available"
+            return "No OCR engines available", False
         
         try:
+            ocr_input = image_array if isinstance(image_array, OcrInput) else OcrInput(image_array)
+            
             # Use only the best available engine to save memory
-            if 'easyocr' in self.engines:
-                reader = self.engines['easyocr']
-                results = reader.readtext(image_array)
-                text_lines = [text for (bbox, text, confidence) in results if confidence > 0.3]
-                result = '\n'.join(text_lines)
-            elif 'tesseract' in self.engines:
-                pytesseract = self.engines['tesseract']
-                if len(image_array.shape) == 3:
-                    image_pil = Image.fromarray(cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB))
-                else:
-                    image_pil = Image.fromarray(image_array)
-                result = pytesseract.image_to_string(image_pil, lang='eng').strip()
+            name, engine = self._select(languages)
+            if name == 'easyocr':
+                image = ocr_input.image
+                if image.dtype != np.uint8 or not image.flags['C_CONTIGUOUS']:
+                    image = np.ascontiguousarray(image, dtype=np.uint8)
+                # detail=0 returns strings only; weak regions are dropped at detection time.
+                # The canvas matches the already-downscaled image so CRAFT never upscales it
+                results = engine.readtext(
+                    image, detail=0, paragraph=False, text_threshold=0.5, low_text=0.3,
+                    canvas_size=max(image.shape[:2]), mag_ratio=1.0
+                )
+                result = '\n'.join(results)
+            elif name == 'tesseract':
+                lang_string = '+'.join(self._LANG_MAP.get(lang, lang) for lang in languages)
+                result = engine.image_to_string(ocr_input.pil_image, lang=lang_string).strip()
             else:
                 # OpenCV fallback
-                result = self._opencv_fallback(image_array)
+                result, ok = self._opencv_fallback(ocr_input)
+                if not ok:
+                    return result, False
             
-            # Force garbage collection
-            gc.collect()
-            return result if result.strip() else "No text detected"
+            return (result if result.strip() else "No text detected"), True
             
         except Exception as e:
             logger.error(f"OCR extraction failed: {e}")
-            gc.collect()
-            return f"OCR processing failed: {str(e)}"
+            return f"OCR processing failed: {str(e)}", False
     
-    def _opencv_fallback(self, image_array):
-        """Minimal OpenCV fallback"""
+    def active_engine(self, languages=['en']):
+        """Name of the engine extract_text would use, or None"""
         try:
-            cv2 = self.engines['opencv']
-            if len(image_array.shape) == 3:
-                gray = cv2.cvtColor(image_array, cv2.COLOR_BGR2GRAY)
-            else:
-                gray = image_array.copy()
-            
-            _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-            contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            return self._select(languages)[0]
+        except RuntimeError:
+            return None
+    
+    def extract_text_batch(self, images, mode='normal', languages=['en']):
+        """Extract (text, ok) for several images, batching inference where supported"""
+        if not images:
+            return []
+        if not self.is_ready():
+            return [("No OCR engines available", False)] * len(images)
+        
+        texts = [None] * len(images)
+        try:
+            name, engine = self._select(languages)
+            if name == 'easyocr':
+                # Padding mixed shapes would grow the detector area, so only
+                # images of identical shape share a detector pass
+                groups = {}
+                for index, image in enumerate(images):
+                    groups.setdefault(image.shape, []).append(index)
+                for shape, indices in groups.items():
+                    if len(indices) < 2:
+                        continue
+                    results = engine.readtext_batched(
+                        [images[index] for index in indices], batch_size=len(indices),
+                        detail=0, paragraph=False, text_threshold=0.5, low_text=0.3,
+                        canvas_size=max(shape[:2]), mag_ratio=1.0
+                    )
+                    for index, lines in zip(indices, results):
+                        texts[index] = ('\n'.join(lines) or "No text detected"), True
+        except Exception as e:
+            logger.warning(f"Batched OCR failed, processing images one by one: {e}")
+        
+        return [
+            text if text is not None else self.extract_text(image, mode, languages)
+            for text, image in zip(texts, images)
+        ]
+    
+    def _opencv_fallback(self, ocr_input):
+        """Minimal OpenCV fallback, returning (text, ok)"""
+        try:
+            cv2 = self._get('opencv')
+            _, binary = cv2.threshold(ocr_input.gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
             
-            text_regions = 0
-            for contour in contours:
-                x, y, w, h = cv2.boundingRect(contour)
-                aspect_ratio = w / h if h > 0 else 0
-                if 0.2 < aspect_ratio < 5.0 and w > 10 and h > 10:
-                    text_regions += 1
+            # Boxes for every component in one call, filtered without a Python loop
+            _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+            w = stats[1:, cv2.CC_STAT_WIDTH]
+            h = stats[1:, cv2.CC_STAT_HEIGHT]
+            mask = (h > 10) & (w > 10) & (w * 5 > h) & (w < h * 5)  # 0.2 < w/h < 5.0
+            text_regions = int(np.count_nonzero(mask))
             
             if text_regions > 0:
-                return f"Detected {text_regions} text regions. Install EasyOCR for full text extraction."
-            return "No clear text regions detected."
+                return f"Detected {text_regions} text regions. Install EasyOCR for full text extraction.", True
+            return "No clear text regions detected.", True
             
         except Exception as e:
-            return f"Basic text detection failed: {str(e)}"
+            return f"Basic text detection failed: {str(e)}", False
 
 class LightweightImageProcessor:
     """Memory-optimized image processor"""
     
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        # Resize buffers reused across files and tasks, one per concurrent worker
+        self._buffers = queue.SimpleQueue()
+    
+    # DCT downscale factor -> (color flag, grayscale flag)
+    _REDUCED_FLAGS = (
+        (8, cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+        (4, cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+        (2, cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    )
+    
+    # EXIF orientation -> cv2.rotate code (mirrored orientations use OpenCV)
+    _EXIF_ROTATIONS = {
+        1: None,
+        3: cv2.ROTATE_180,
+        6: cv2.ROTATE_90_CLOCKWISE,
+        8: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    }
+    
     @staticmethod
-    def preprocess_image(image_data, max_size=1024):
+    def decode_image(image_data, max_size=1024, grayscale=False):
+        """Decode bytes, letting libjpeg downscale large JPEGs during decode"""
+        full_flag = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+        if image_data[:2] != b'\xff\xd8':
+            return cv2.imdecode(np.frombuffer(image_data, np.uint8), full_flag)
+        
+        factor, flag, orientation = 1, full_flag, None
+        try:
+            # Reads the header only, pixels are not decoded
+            header = Image.open(image_data if isinstance(image_data, mmap.mmap) else io.BytesIO(image_data))
+            width, height = header.size
+            orientation = header.getexif().get(0x0112, 1)
+            for factor, color_flag, gray_flag in LightweightImageProcessor._REDUCED_FLAGS:
+                if max(width, height) // factor >= max_size:
+                    flag = gray_flag if grayscale else color_flag
+                    break
+            else:
+                factor = 1
+        except Exception:
+            pass
+        
+        # TurboJPEG decodes straight to grayscale, skipping the color conversion
+        rotation = LightweightImageProcessor._EXIF_ROTATIONS.get(orientation, False)
+        if grayscale and _turbo_jpeg is not None and rotation is not False:
+            try:
+                image = _turbo_jpeg.decode(
+                    image_data,
+                    pixel_format=TJPF_GRAY,
+                    scaling_factor=(1, factor) if factor > 1 else None
+                )
+                image = image.reshape(image.shape[:2])
+                return cv2.rotate(image, rotation) if rotation is not None else image
+            except Exception as e:
+                logger.warning(f"TurboJPEG decode failed, using OpenCV: {e}")
+        
+        return cv2.imdecode(np.frombuffer(image_data, np.uint8), flag)
+    
+    def preprocess_image(self, image_data, max_size=1024):
         """Lightweight image preprocessing"""
         try:
-            if isinstance(image_data, bytes):
-                nparr = np.frombuffer(image_data, np.uint8)
-                image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            if isinstance(image_data, (bytes, mmap.mmap)):
+                image = self.decode_image(image_data, max_size, grayscale=True)
             else:
                 image = image_data
             
             if image is None:
                 raise ValueError("Could not decode image")
             
-            # Aggressive resizing for memory efficiency
             height, width = image.shape[:2]
-            if max(height, width) > max_size:
-                scale = max_size / max(height, width)
-                new_width = int(width * scale)
-                new_height = int(height * scale)
-                image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
+            if max(height, width) <= max_size:
+                return self.binarize(image)
             
-            # Simple grayscale conversion
-            if len(image.shape) == 3:
-                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            else:
-                gray = image
+            # Aggressive resizing for memory efficiency, into a reused buffer
+            scale = max_size / max(height, width)
+            new_width = int(width * scale)
+            new_height = int(height * scale)
+            with self._scratch((new_height, new_width) + image.shape[2:]) as resized:
+                # OpenCV ignores dst when its dtype differs from the input, so keep the result
+                resized = cv2.resize(image, (new_width, new_height), dst=resized, interpolation=cv2.INTER_AREA)
+                del image
+                return self.binarize(resized)
             
-            # Basic enhancement only
-            enhanced = cv2.medianBlur(gray, 3)
-            processed = cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+        except Exception as e:
+            logger.error(f"Image preprocessing failed: {e}")
+            raise ValueError(f"Image processing failed: {str(e)}")
+    
+    def decode_and_resize(self, image_data, max_size=1024):
+        """Decode to BGR capped at max_size, for engines that normalize input themselves"""
+        try:
+            image = self.decode_image(image_data, max_size)
+            if image is None:
+                raise ValueError("Could not decode image")
             
-            return processed
+            height, width = image.shape[:2]
+            if max(height, width) > max_size:
+                scale = max_size / max(height, width)
+                image = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+            return image
             
         except Exception as e:
-            logger.error(f"Image preprocessing failed: {e}")
+            logger.error(f"Image decoding failed: {e}")
             raise ValueError(f"Image processing failed: {str(e)}")
+    
+    @contextmanager
+    def _scratch(self, shape):
+        """Borrow a pooled buffer viewed as a C-contiguous uint8 array of shape"""
+        size = int(np.prod(shape))
+        try:
+            buffer = self._buffers.get_nowait()
+        except queue.Empty:
+            buffer = np.empty(self.max_size * self.max_size * 3, np.uint8)
+        if buffer.size < size:
+            buffer = np.empty(size, np.uint8)
+        try:
+            yield buffer[:size].reshape(shape)
+        finally:
+            self._buffers.put(buffer)
+    
+    @staticmethod
+    def binarize(image):
+        """Basic enhancement only, the grayscale image is the fallback"""
+        try:
+            # The threshold is written over the median output, one buffer for both passes
+            enhanced = cv2.medianBlur(LightweightImageProcessor._to_gray(image), 3)
+            return cv2.adaptiveThreshold(
+                enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2, dst=enhanced
+            )
+        except Exception as e:
+            logger.warning(f"Image enhancement failed, using grayscale: {e}")
+            # Copy, the input may be a pooled scratch buffer
+            return np.array(LightweightImageProcessor._to_gray(image))
+    
+    @staticmethod
+    def _to_gray(image):
+        """Simple grayscale conversion"""
+        if len(image.shape) == 3:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image
+
+class OCRResultCache:
+    """Thread-safe LRU cache of OCR text keyed by image content"""
+    
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(image_data, mode, languages):
+        digest = hashlib.md5(image_data, usedforsecurity=False).hexdigest()
+        return (digest, mode, tuple(languages))
+    
+    def get(self, key):
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+            return text
+    
+    def put(self, key, text):
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
 
 # Initialize components
 ocr_engine = OptimizedOCREngine()
 image_processor = LightweightImageProcessor()
+result_cache = OCRResultCache()
+
+# Load and warm the primary engine off the import path so the first upload is fast
+if os.environ.get('OCR_WARMUP', '1') == '1':
+    threading.Thread(target=ocr_engine.warm_up, name='ocr-warmup', daemon=True).start()
 
 # Flask app configuration
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024  # 8MB limit for Railway
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'railway-production-key')
 
-# In-memory task storage (no file system usage)
-processing_tasks = {}
+# In-memory task storage (no file system usage), kept in creation order
+processing_tasks = OrderedDict()
+tasks_lock = threading.RLock()
+TASK_TTL = 1800  # 30 minutes
+
+# Per-task file parallelism (OpenCV and OCR backends release the GIL)
+MAX_FILE_WORKERS = max(2, min(8, os.cpu_count() or 1))  # 2+ so decode overlaps OCR
+
+# Persistent worker(s) draining the upload task queue; tasks run back-to-back
+OCR_WORKERS = max(1, int(os.environ.get('OCR_WORKERS', '1')))
+task_executor = ThreadPoolExecutor(
+    max_workers=OCR_WORKERS,
+    thread_name_prefix='ocr-task'
+)
+MAX_PENDING_TASKS = 2  # queued + running tasks before /upload answers 429
+pending_tasks = 0
+
+def ojson(obj, status=200):
+    """JSON response encoded with orjson when available"""
+    if orjson is not None:
+        body = orjson.dumps(obj)
+    else:
+        body = json.dumps(obj, separators=(',', ':'))
+    return app.response_class(body, status=status, mimetype='application/json')
 
 def cleanup_tasks():
     """Aggressive task cleanup for memory management"""
-    current_time = time.time()
-    tasks_to_remove = [
-        task_id for task_id, task in processing_tasks.items()
-        if current_time - task.get('created_at', current_time) > 1800  # 30 minutes
-    ]
-    
-    for task_id in tasks_to_remove:
-        processing_tasks.pop(task_id, None)
+    # Oldest tasks are first, so stop at the first one still alive
+    expire_before = time.time() - TASK_TTL
+    with tasks_lock:
+        while processing_tasks:
+            task = next(iter(processing_tasks.values()))
+            if task['created_at'] > expire_before:
+                break
+            processing_tasks.popitem(last=False)
+        idle = not processing_tasks
     
-    # Force garbage collection
-    gc.collect()
+    # Full collection only while idle, so it never stalls a running task
+    if idle:
+        gc.collect()
 
 @app.route('/')
 def index():
     """Main page"""
     try:
-        cleanup_tasks()
+        # Rendered per request so url_for sees the real script root and host;
+        # Jinja keeps the compiled template cached between calls
         ocr_status = "ready" if ocr_engine.is_ready() else "limited"
         return render_template('index.html', ocr_status=ocr_status)
     except Exception as e:
         logger.error(f"Index page error: {e}")
         return f"Application error: {str(e)}", 500
 
+# Engine registration is fixed at startup, so only the task count varies per probe
+_HEALTH_PREFIX = b'{"status":"healthy","ocr_ready":%s,"active_tasks":' % (
+    b'true' if ocr_engine.is_ready() else b'false'
+)
+
 @app.route('/health')
 def health_check():
     """Health check for Railway"""
-    return jsonify({
-        'status': 'healthy',
-        'ocr_ready': ocr_engine.is_ready(),
-        'active_tasks': len(processing_tasks)
-    })
+    return app.response_class(
+        _HEALTH_PREFIX + str(len(processing_tasks)).encode() + b'}',
+        mimetype='application/json'
+    )
 
 @app.route('/status')
 def get_status():
     """Service status"""
     try:
         cleanup_tasks()
-        engines_status = [{'name': name, 'status': 'available'} for name in ocr_engine.engines.keys()]
+        engines_status = [{'name': name, 'status': 'available'} for name in ocr_engine.available_engines()]
         
-        return jsonify({
+        return ojson({
             'status': 'ready' if ocr_engine.is_ready() else 'limited',
             'engines': engines_status,
             'active_tasks': len(processing_tasks),
             'memory_optimized': True
         })
     except Exception as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        return ojson({'status': 'error', 'message': str(e)}, 500)
+
+def _upload_buffer(file):
+    """Bytes-like upload contents, mapped or shared instead of copied where possible"""
+    stream = file.stream
+    # _rolled/_file are private to SpooledTemporaryFile (checked on CPython 3.8-3.13);
+    # without them the upload is simply read
+    if isinstance(stream, tempfile.SpooledTemporaryFile):
+        if not (hasattr(stream, '_rolled') and hasattr(stream, '_file')):
+            return file.read()
+        if stream._rolled:
+            # Spooled to disk: map it, the mapping outlives closing the file
+            try:
+                return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                stream.seek(0)
+                return stream.read()
+        stream = stream._file
+    if isinstance(stream, io.BytesIO):
+        # Shares the buffer until the stream is written again
+        return stream.getvalue()
+    return file.read()
+
+def _release_buffers(buffers):
+    """Unmap upload buffers that _upload_buffer mapped from spooled files"""
+    for data in buffers:
+        if isinstance(data, mmap.mmap):
+            try:
+                data.close()
+            except BufferError:
+                # A decoder still holds a view; the mapping is freed with it
+                pass
 
 @app.route('/upload', methods=['POST'])
 def upload_files():
     """Handle file upload with strict limits"""
+    global pending_tasks
     try:
         cleanup_tasks()
         
         if not ocr_engine.is_ready():
-            return jsonify({'error': 'OCR service unavailable'}), 503
-        
-        # Limit concurrent tasks for Railway
-        if len(processing_tasks) >= 2:
-            return jsonify({'error': 'Server busy. Please try again in a few minutes.'}), 429
+            return ojson({'error': 'OCR service unavailable'}, 503)
         
         if 'files' not in request.files:
-            return jsonify({'error': 'No files uploaded'}), 400
+            return ojson({'error': 'No files uploaded'}, 400)
         
         files = request.files.getlist('files')
         mode = 'normal'  # Force normal mode only
@@ -254,163 +598,247 @@ def upload_files():
         
         # Limit to 3 files max for Railway
         if len(files) > 3:
-            return jsonify({'error': 'Maximum 3 files allowed'}), 400
+            return ojson({'error': 'Maximum 3 files allowed'}, 400)
         
         valid_files = []
         for file in files:
             if file.filename:
                 allowed_extensions = {'.png', '.jpg', '.jpeg', '.bmp'}
                 file_ext = os.path.splitext(file.filename)[1].lower()
-                if file_ext in allowed_extensions:
-                    file.seek(0, 2)
-                    file_size = file.tell()
-                    file.seek(0)
-                    
-                    if file_size <= app.config['MAX_CONTENT_LENGTH']:
-                        valid_files.append(file)
+                # The request body is capped by MAX_CONTENT_LENGTH; a part's own
+                # Content-Length header, when sent, is checked without touching the stream
+                if file_ext in allowed_extensions and (file.content_length or 0) <= app.config['MAX_CONTENT_LENGTH']:
+                    # Take the data now, the upload stream is closed once the request ends
+                    valid_files.append((_upload_buffer(file), secure_filename(file.filename)))
+                    file.close()
         
         if not valid_files:
-            return jsonify({'error': 'No valid files found'}), 400
+            return ojson({'error': 'No valid files found'}, 400)
         
         task_id = str(uuid.uuid4())
-        processing_tasks[task_id] = {
-            'status': 'starting',
-            'progress': 0,
-            'files_processed': 0,
-            'total_files': len(valid_files),
-            'results': [],
-            'created_at': time.time()
-        }
-        
-        # Process synchronously for Railway (no threading issues)
-        thread = threading.Thread(
-            target=process_images_sync,
-            args=(task_id, valid_files),
-            daemon=True
-        )
-        thread.start()
+        with tasks_lock:
+            # Limit queued work for Railway, finished tasks don't count
+            if pending_tasks >= MAX_PENDING_TASKS:
+                _release_buffers(data for data, _ in valid_files)
+                return ojson({'error': 'Server busy. Please try again in a few minutes.'}, 429)
+            pending_tasks += 1
+            
+            processing_tasks[task_id] = {
+                'status': 'starting',
+                'progress': 0,
+                'files_processed': 0,
+                'total_files': len(valid_files),
+                'results': [],
+                'created_at': time.time()
+            }
+        
+        # Queue on the persistent task worker instead of a thread per request
+        task_executor.submit(process_images_sync, task_id, valid_files)
         
-        return jsonify({'task_id': task_id})
+        return ojson({'task_id': task_id})
         
     except RequestEntityTooLarge:
-        return jsonify({'error': 'File too large. Maximum 8MB per file.'}), 413
+        return ojson({'error': 'File too large. Maximum 8MB per file.'}, 413)
     except Exception as e:
         logger.error(f"Upload error: {e}")
-        return jsonify({'error': f'Upload failed: {str(e)}'}), 500
+        return ojson({'error': f'Upload failed: {str(e)}'}, 500)
 
 @app.route('/progress/<task_id>')
 def get_progress(task_id):
     """Get processing progress"""
     try:
-        if task_id not in processing_tasks:
-            return jsonify({'error': 'Task not found'}), 404
+        with tasks_lock:
+            task = processing_tasks.get(task_id)
+            if task is None:
+                return ojson({'error': 'Task not found'}, 404)
+            
+            # Unchanged polls are answered without serializing anything
+            etag = f"{task['progress']}-{task['files_processed']}-{task['status']}"
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                payload = {key: task[key] for key in ('status', 'progress', 'files_processed', 'total_files')}
+                # Results are only sent once, with the final state
+                if task['status'] == 'completed':
+                    payload['results'] = task['results']
+                elif task['status'] == 'error':
+                    payload['error'] = task.get('error')
+                response = ojson(payload)
         
-        task = processing_tasks[task_id]
-        return jsonify(task)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojson({'error': str(e)}, 500)
 
 @app.route('/download/<task_id>')
 def download_results(task_id):
     """Download results"""
     try:
-        if task_id not in processing_tasks:
-            return jsonify({'error': 'Task not found'}), 404
+        with tasks_lock:
+            task = processing_tasks.get(task_id)
+        if task is None:
+            return ojson({'error': 'Task not found'}, 404)
         
-        task = processing_tasks[task_id]
         if task['status'] != 'completed':
-            return jsonify({'error': 'Task not completed'}), 400
+            return ojson({'error': 'Task not completed'}, 400)
         
         if not task['results']:
-            return jsonify({'error': 'No results available'}), 404
+            return ojson({'error': 'No results available'}, 404)
         
-        # Create results
-        results_lines = [
-            f"OCR Results - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-            "=" * 50, ""
-        ]
-        
-        for i, result in enumerate(task['results'], 1):
-            results_lines.extend([
-                f"File {i}: {result['filename']}",
-                "-" * 30,
-                result['text'],
-                ""
-            ])
-        
-        results_content = '\n'.join(results_lines)
-        output = io.BytesIO(results_content.encode('utf-8'))
-        output.seek(0)
-        
-        filename = f"ocr_results_{task_id[:8]}.txt"
+        # Results are final once completed, so the file is built once per task.
+        # Held in memory rather than streamed: at most 3 files of text, and the
+        # stored bytes allow ETag/304 and Range responses on repeat downloads
+        cached = task.get('_download_cache')
+        if cached is None:
+            parts = [f"OCR Results - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n" + "=" * 50 + "\n\n"]
+            for i, result in enumerate(task['results'], 1):
+                parts.append(f"File {i}: {result['filename']}\n{'-' * 30}\n{result['text']}\n\n")
+            body = ''.join(parts).encode('utf-8')
+            cached = task['_download_cache'] = (body, hashlib.md5(body, usedforsecurity=False).hexdigest())
+        body, etag = cached
         
         return send_file(
-            output,
+            io.BytesIO(body),
+            mimetype='text/plain',
             as_attachment=True,
-            download_name=filename,
-            mimetype='text/plain'
+            download_name=f"ocr_results_{task_id[:8]}.txt",
+            conditional=True,
+            etag=etag
         )
         
     except Exception as e:
         logger.error(f"Download error: {e}")
-        return jsonify({'error': f'Download failed: {str(e)}'}), 500
+        return ojson({'error': f'Download failed: {str(e)}'}, 500)
+
+def _preprocess_one(file_data, filename, binarize=True):
+    """Decode and preprocess one file, returning (image, error text)"""
+    try:
+        if binarize:
+            return image_processor.preprocess_image(file_data), None
+        return image_processor.decode_and_resize(file_data), None
+    except Exception as e:
+        logger.error(f"Error processing {filename}: {e}")
+        return None, f"Error: {str(e)}"
+
+def _make_result(filename, text):
+    return {
+        'filename': filename,
+        'text': text,
+        'ts': time.time()
+    }
 
 def process_images_sync(task_id, files):
-    """Synchronous processing optimized for Railway"""
+    """Process (file_data, filename) pairs concurrently optimized for Railway"""
+    global pending_tasks
+    # files is cleared as it is consumed; keep only the mappings that need closing
+    buffers = [data for data, _ in files if isinstance(data, mmap.mmap)]
     try:
-        task = processing_tasks[task_id]
-        task['status'] = 'processing'
+        with tasks_lock:
+            task = processing_tasks[task_id]
+            task['status'] = 'processing'
         
-        for i, file in enumerate(files):
-            try:
-                task['progress'] = int((i / len(files)) * 100)
-                task['files_processed'] = i
-                
-                file_data = file.read()
-                filename = secure_filename(file.filename)
-                
-                # Process image with memory optimization
-                processed_image = image_processor.preprocess_image(file_data)
-                text = ocr_engine.extract_text(processed_image, 'normal', ['en'])
+        mode, languages = 'normal', ('en',)
+        results = [None] * len(files)
+        first_index = {}  # cache key -> index of the first file with that content
+        duplicates = {}   # index -> (index of first copy, filename)
+        
+        # EasyOCR runs its own normalization on the color image and batches
+        # across files; binarized input only helps Tesseract and the fallback
+        use_easyocr = ocr_engine.active_engine(list(languages)) == 'easyocr'
+        
+        workers = min(MAX_FILE_WORKERS, len(files)) or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for i, (file_data, filename) in enumerate(files):
+                # Release the batch's reference so bytes are freed as each file finishes
+                files[i] = None
+                cache_key = result_cache.make_key(file_data, mode, languages)
                 
-                task['results'].append({
-                    'filename': filename,
-                    'text': text,
-                    'processed_at': datetime.now().isoformat()
-                })
+                # Identical content in the same batch is only OCR'd once
+                if cache_key in first_index:
+                    duplicates[i] = (first_index[cache_key], filename)
+                    continue
+                first_index[cache_key] = i
                 
-                # Force cleanup after each file
-                del file_data, processed_image
-                gc.collect()
+                # Repeat uploads reuse cached text
+                cached_text = result_cache.get(cache_key)
+                if cached_text is not None:
+                    results[i] = _make_result(filename, cached_text)
+                    continue
                 
-            except Exception as e:
-                logger.error(f"Error processing {file.filename}: {e}")
-                task['results'].append({
-                    'filename': secure_filename(file.filename),
-                    'text': f"Error: {str(e)}",
-                    'processed_at': datetime.now().isoformat()
-                })
+                future = executor.submit(_preprocess_one, file_data, filename, not use_easyocr)
+                futures[future] = (i, filename, cache_key)
+            file_data = None
+            
+            # EasyOCR gets everything at once after decoding; other engines start
+            # OCR per file as soon as it is ready, overlapping remaining decodes
+            images, targets, ocr_futures = [], [], {}
+            for done, future in enumerate(as_completed(futures), 1):
+                i, filename, cache_key = futures[future]
+                image, error = future.result()
+                if error is not None:
+                    results[i] = _make_result(filename, error)
+                elif use_easyocr:
+                    images.append(image)
+                    targets.append((i, filename, cache_key))
+                else:
+                    ocr_future = executor.submit(ocr_engine.extract_text, image, mode, list(languages))
+                    ocr_futures[ocr_future] = (i, filename, cache_key)
+                with tasks_lock:
+                    task['progress'] = int((done / len(futures)) * 50)
+            
+            if use_easyocr:
+                texts = ocr_engine.extract_text_batch(images, mode, list(languages))
+                finished = list(zip(targets, texts))
+                images = None
+            else:
+                finished = ((ocr_futures[f], f.result()) for f in as_completed(ocr_futures))
+            
+            total = len(targets) + len(ocr_futures)
+            for done, ((i, filename, cache_key), (text, ok)) in enumerate(finished, 1):
+                # Failures may be transient, so only successful text is replayed
+                if ok:
+                    result_cache.put(cache_key, text)
+                results[i] = _make_result(filename, text)
+                with tasks_lock:
+                    task['files_processed'] = done
+                    task['progress'] = 50 + int((done / total) * 50)
         
-        task['status'] = 'completed'
-        task['progress'] = 100
-        task['files_processed'] = len(files)
+        for i, (first, filename) in duplicates.items():
+            results[i] = dict(results[first], filename=filename)
+        
+        with tasks_lock:
+            task['results'] = results
+            task['status'] = 'completed'
+            task['progress'] = 100
+            task['files_processed'] = len(results)
         
     except Exception as e:
         logger.error(f"Processing error: {e}")
-        task['status'] = 'error'
-        task['error'] = str(e)
+        with tasks_lock:
+            task['status'] = 'error'
+            task['error'] = str(e)
+    
+    finally:
+        _release_buffers(buffers)
+        with tasks_lock:
+            pending_tasks -= 1
 
 @app.errorhandler(404)
 def not_found(error):
-    return jsonify({'error': 'Not found'}), 404
+    return ojson({'error': 'Not found'}, 404)
 
 @app.errorhandler(413)
 def file_too_large(error):
-    return jsonify({'error': 'File too large'}), 413
+    return ojson({'error': 'File too large'}, 413)
 
 @app.errorhandler(500)
 def internal_error(error):
-    return jsonify({'error': 'Internal server error'}), 500
+    return ojson({'error': 'Internal server error'}, 500)
+
+# Long-lived startup objects are moved out of the collector's view
+gc.freeze()
 
 if __name__ == '__main__':
     try:
@@ -327,7 +327,7 @@ class OCRService {
             <div class="result-item fade-in" style="animation-delay: ${index * 0.1}s">
                 <div class="result-header">
                     <h5 class="result-filename">${this.escapeHtml(result.filename)}</h5>
-                    ${result.processed_at ? `<span class="result-timestamp">${new Date(result.processed_at).toLocaleString()}</span>` : ''}
+                    ${result.ts ? `<span class="result-timestamp">${new Date(result.ts * 1000).toLocaleString()}</span>` : ''}
                 </div>
                 <div class="result-text">${this.escapeHtml(result.text)}</div>
             </div>